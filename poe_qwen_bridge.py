@@ -1,19 +1,37 @@
 # poe_qwen_bridge.py
 import modal
+import asyncio
+import hashlib
+import itertools
 import os
 import re
 import time
 import json
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import StreamingResponse
+import httpx
+import msgspec
+import orjson
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.responses import Response
 import fastapi_poe as fp
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Tuple
 
 # --- CONFIGURATION ---
 DEFAULT_POE_MODEL = "Qwen-3-235B-0527-T"
 POE_API_KEY = os.environ.get("POE_CALLER_API_KEY1")
 MODAL_AUTH_TOKEN = os.environ.get("MODAL_AUTH_TOKEN")
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 10_000))
+LLM_CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", 3600))
+# Requests per container; the work is almost all waiting on Poe, so one event
+# loop handles far more than a handful at once
+MAX_CONCURRENT_INPUTS = 128
+# Upper bound on simultaneous Poe calls per container, to stay under Poe's
+# rate limits if they turn out lower than MAX_CONCURRENT_INPUTS
+POE_MAX_CONCURRENT_CALLS = int(os.environ.get("POE_MAX_CONCURRENT_CALLS", MAX_CONCURRENT_INPUTS))
+
+# Matches a leading "#@Model-Name" override in the user's latest message
+MODEL_OVERRIDE_RE = re.compile(r"^\s*#@([\w.-]+)\s*")
 
 # --- NEW: THE MASTER AGENT SYSTEM PROMPT ---
 # This prompt gives the Poe bot its core identity and instructions.
@@ -32,53 +50,86 @@ Correct Tool Use Example:
 3.  **Standard Chat:** If you are just answering a question, providing an explanation, or writing a code snippet without using a tool, respond in plain Markdown as a standard chatbot. Do NOT use the JSON tool format for this.
 """
 
-# --- OPENAI-COMPATIBLE DATA MODELS ---
-# (These are expanded to fully support tool calls)
-class OpenAIMessage(BaseModel):
-    role: str
-    content: Optional[str] = None
-    tool_calls: Optional[List[Dict]] = None
-    tool_call_id: Optional[str] = None
+# Static prompt framing, UTF-8 encoded once; prompts are assembled as bytes
+AGENT_PROMPT_HEADER = (AGENT_SYSTEM_PROMPT + "\n\n").encode()
+HISTORY_SEPARATOR = b"\n\n--- CONVERSATION HISTORY & CURRENT REQUEST ---\n"
+ASSISTANT_TAIL = b"\n\n**assistant**:"
+NO_TOOLS_MANIFEST = b"No tools are available for this request."
 
-class OpenAIChatRequest(BaseModel):
-    model: str
-    messages: List[OpenAIMessage]
-    tools: Optional[List[Dict]] = None
-    tool_choice: Optional[Any] = None
-    stream: Optional[bool] = False
+# --- ID Generation ---
+# Response and tool-call IDs are identifiers, not secrets: a per-process
+# random seed drawn once plus a counter keeps them unique across containers
+# without a getrandom syscall per ID.
+_ID_SEED = os.urandom(8).hex()
+_id_counter = itertools.count()
 
-class FunctionCall(BaseModel):
+def next_id(prefix: str) -> str:
+    """Returns a unique ID such as "chatcmpl-<seed><counter>"."""
+    return f"{prefix}{_ID_SEED}{next(_id_counter):08x}"
+
+# --- OPENAI-COMPATIBLE DATA MODELS ---
+# (These are expanded to fully support tool calls)
+# Requests are read straight from the JSON body (see chat_completions), so
+# only the response side is modelled here, as msgspec Structs that encode
+# straight to JSON bytes. kw_only keeps fields in OpenAI's order.
+class FunctionCall(msgspec.Struct, kw_only=True):
     name: str
     arguments: str
 
-class ToolCall(BaseModel):
-    id: str = Field(default_factory=lambda: "call_" + os.urandom(8).hex())
+class ToolCall(msgspec.Struct, kw_only=True):
+    id: str = msgspec.field(default_factory=lambda: next_id("call_"))
     type: str = "function"
     function: FunctionCall
 
-class AssistantMessage(BaseModel):
+class AssistantMessage(msgspec.Struct, kw_only=True):
     role: str = "assistant"
     content: Optional[str] = None
     tool_calls: Optional[List[ToolCall]] = None
 
-class ChatCompletionChoice(BaseModel):
+class ChatCompletionChoice(msgspec.Struct, kw_only=True):
     index: int = 0
     message: AssistantMessage
     finish_reason: str
 
-class OpenAIChatResponse(BaseModel):
-    id: str = Field(default_factory=lambda: "chatcmpl-" + os.urandom(12).hex())
+class OpenAIChatResponse(msgspec.Struct, kw_only=True):
+    id: str = msgspec.field(default_factory=lambda: next_id("chatcmpl-"))
     object: str = "chat.completion"
-    created: int = Field(default_factory=lambda: int(time.time()))
+    created: int = msgspec.field(default_factory=lambda: int(time.time()))
     model: str
     choices: List[ChatCompletionChoice]
 
+# One encoder for every response, so a new msgspec Encoder isn't built per call
+_response_encoder = msgspec.json.Encoder()
+
+def encode_response(response: OpenAIChatResponse) -> Response:
+    """Serializes a chat completion into a JSON response."""
+    return Response(content=_response_encoder.encode(response), media_type="application/json")
+
 # --- Tool Formatting Helper ---
-def format_tools_for_prompt(tools: Optional[List[Dict]]) -> str:
-    """Converts the OpenAI tool list into a simple text manifest for the prompt."""
+# Agentic clients resend the same tool list on every request, so manifests are
+# memoized by a hash of the list (least recently used evicted past the limit).
+TOOL_MANIFEST_CACHE_SIZE = 64
+_tool_manifest_cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+
+def format_tools_for_prompt(tools: Optional[List[Dict]]) -> bytes:
+    """Converts the OpenAI tool list into a UTF-8 text manifest for the prompt."""
     if not tools:
-        return "No tools are available for this request."
-    
+        return NO_TOOLS_MANIFEST
+
+    key = hashlib.blake2b(orjson.dumps(tools, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+    manifest = _tool_manifest_cache.get(key)
+    if manifest is not None:
+        _tool_manifest_cache.move_to_end(key)
+        return manifest
+
+    manifest = build_tool_manifest(tools).encode()
+    _tool_manifest_cache[key] = manifest
+    if len(_tool_manifest_cache) > TOOL_MANIFEST_CACHE_SIZE:
+        _tool_manifest_cache.popitem(last=False)
+    return manifest
+
+def build_tool_manifest(tools: List[Dict]) -> str:
+    """Formats a non-empty tool list; use format_tools_for_prompt for the cached version."""
     formatted_string = "## Available Tools for This Request\n"
     for tool in tools:
         if tool.get("type") == "function" and "function" in tool:
@@ -89,11 +140,91 @@ def format_tools_for_prompt(tools: Optional[List[Dict]]) -> str:
             formatted_string += f"- **{name}**: {description}\n  - Parameters: `{parameters}`\n"
     return formatted_string
 
+# --- Shared Poe HTTP Session ---
+# One long-lived client per container, so Poe calls reuse warm TCP/TLS
+# connections instead of handshaking on every request. Opened in the app
+# lifespan; while it is None, fastapi_poe falls back to a per-call client.
+_poe_session: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _poe_session
+    _poe_session = httpx.AsyncClient(
+        http2=True,
+        timeout=600,  # Same as fastapi_poe's own client; bot replies can be slow
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=MAX_CONCURRENT_INPUTS),
+    )
+    try:
+        yield
+    finally:
+        await _poe_session.aclose()
+        _poe_session = None
+
+# --- Poe Call Coalescing ---
+# Identical prompts for the same bot that arrive while a Poe call is already
+# in flight (IDE re-queries, client retries) share that call instead of
+# opening a new one.
+_inflight_poe_calls: Dict[bytes, "asyncio.Task[str]"] = {}
+_poe_call_slots = asyncio.Semaphore(POE_MAX_CONCURRENT_CALLS)
+
+def poe_request_key(selected_model: str, prompt: bytes) -> bytes:
+    """Returns a privacy-preserving key identifying a (model, encoded prompt) pair."""
+    digest = hashlib.sha256(selected_model.encode())
+    digest.update(b"\0")
+    digest.update(prompt)
+    return digest.digest()
+
+async def fetch_poe_text(prompt: str, selected_model: str) -> str:
+    """Sends the prompt to Poe and returns the full reply text."""
+    poe_messages = [fp.ProtocolMessage(role="user", content=prompt)]
+    chunks: List[str] = []
+    async with _poe_call_slots:
+        # Non-streaming is better for parsing tool calls vs. text
+        async for partial in fp.get_bot_response(messages=poe_messages, bot_name=selected_model, api_key=POE_API_KEY, session=_poe_session):
+            chunks.append(partial.text)
+    return "".join(chunks)
+
+async def get_poe_text(key: bytes, prompt: str, selected_model: str) -> str:
+    """Like fetch_poe_text, but joins an identical in-flight call if there is one."""
+    task = _inflight_poe_calls.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_poe_text(prompt, selected_model))
+        _inflight_poe_calls[key] = task
+        task.add_done_callback(lambda _: _inflight_poe_calls.pop(key, None))
+    # Shield so one caller disconnecting doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+# --- Response Cache ---
+# Parsed replies (the response choice) keyed by poe_request_key. A hit skips
+# Poe but still gets a fresh response envelope, so every completion keeps its
+# own id and created time. Entries expire after LLM_CACHE_TTL_SECONDS and the
+# least recently used entry is evicted once LLM_CACHE_MAX_ENTRIES is exceeded.
+_response_cache: "OrderedDict[bytes, Tuple[float, ChatCompletionChoice]]" = OrderedDict()
+
+def get_cached_choice(key: bytes) -> Optional[ChatCompletionChoice]:
+    """Returns the cached choice for the key, or None if absent or expired."""
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    stored_at, choice = entry
+    if time.monotonic() - stored_at > LLM_CACHE_TTL_SECONDS:
+        del _response_cache[key]
+        return None
+    _response_cache.move_to_end(key)
+    return choice
+
+def cache_choice(key: bytes, choice: ChatCompletionChoice) -> None:
+    """Stores a parsed choice, evicting the least recently used entries if full."""
+    _response_cache[key] = (time.monotonic(), choice)
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > LLM_CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
 # --- FASTAPI APP ---
-app = FastAPI(title="Poe to Qwen-Code Agent Bridge")
+app = FastAPI(title="Poe to Qwen-Code Agent Bridge", lifespan=lifespan)
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: OpenAIChatRequest, authorization: Optional[str] = Header(None)):
+async def chat_completions(request: Request, authorization: Optional[str] = Header(None)):
     # (Authentication logic remains the same)
     if not MODAL_AUTH_TOKEN or not POE_API_KEY:
         raise HTTPException(status_code=500, detail="Server not configured.")
@@ -103,51 +234,95 @@ async def chat_completions(request: OpenAIChatRequest, authorization: Optional[s
     if token != MODAL_AUTH_TOKEN:
         raise HTTPException(status_code=401, detail="Invalid API Key.")
 
+    # --- Parse the Request Body ---
+    # Decoded with orjson and used as plain dicts: validating every message of
+    # a long agent history through Pydantic costs far more than these checks.
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="Request body is not valid JSON.")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=422, detail="Request body must be a JSON object.")
+    messages = body.get("messages")
+    tools = body.get("tools")
+    stream = body.get("stream", False)
+    if tools is not None and not (isinstance(tools, list) and all(isinstance(tool, dict) for tool in tools)):
+        raise HTTPException(status_code=422, detail="'tools' must be a list of objects.")
+
     # --- Construct the Full Agentic Prompt ---
-    if not request.messages:
+    if not messages:
         raise HTTPException(status_code=400, detail="No messages provided.")
-    
-    # Format the conversation history into a simple string
-    conversation_history = "\n".join([f"**{msg.role}**: {msg.content or ''}" for msg in request.messages])
-    
-    # Get the dynamic list of tools for this specific request
-    dynamic_tool_list = format_tools_for_prompt(request.tools)
-    
-    # Combine everything into the final prompt for Poe
-    final_prompt_to_poe = (
-        f"{AGENT_SYSTEM_PROMPT}\n\n"
-        f"{dynamic_tool_list}\n\n"
-        f"--- CONVERSATION HISTORY & CURRENT REQUEST ---\n"
-        f"{conversation_history}\n\n"
-        f"**assistant**:"
-    )
+    if not isinstance(messages, list):
+        raise HTTPException(status_code=422, detail="'messages' must be a list.")
+
+    lone_message = messages[0] if len(messages) == 1 else None
+    if (
+        not tools
+        and isinstance(lone_message, dict)
+        and lone_message.get("role") == "user"
+        and isinstance(lone_message.get("content"), str)
+        and lone_message["content"]
+    ):
+        # A lone user question with no tools is plain chat: send it as-is,
+        # without the agent instructions, tool manifest or history framing
+        prompt_bytes = lone_message["content"].encode()
+    else:
+        # Format the conversation history into a simple string
+        history_parts: List[str] = []
+        for msg in messages:
+            if not isinstance(msg, dict):
+                raise HTTPException(status_code=422, detail="Each message must be an object.")
+            role = msg.get("role")
+            content = msg.get("content") or ""
+            if not isinstance(role, str) or not isinstance(content, str):
+                raise HTTPException(status_code=422, detail="Each message needs a string 'role' and 'content'.")
+            history_parts += ("**", role, "**: ", content, "\n")
+        history_parts.pop()  # No newline after the last message
+        conversation_history = "".join(history_parts)
+
+        # Combine everything into the final prompt for Poe, with the dynamic
+        # list of tools for this specific request
+        prompt_bytes = bytearray(AGENT_PROMPT_HEADER)
+        prompt_bytes += format_tools_for_prompt(tools)
+        prompt_bytes += HISTORY_SEPARATOR
+        prompt_bytes += conversation_history.encode()
+        prompt_bytes += ASSISTANT_TAIL
 
     # (Model selection logic remains the same)
     selected_model = DEFAULT_POE_MODEL
-    model_match = re.match(r"^\s*#@([\w.-]+)\s*", request.messages[-1].content or "")
+    model_match = MODEL_OVERRIDE_RE.match(messages[-1].get("content") or "")
     if model_match:
         selected_model = model_match.group(1)
 
+    # Tool-using and streaming requests are never served from the cache
+    request_key = poe_request_key(selected_model, prompt_bytes)
+    use_cache = not tools and not stream
+    if use_cache:
+        cached_choice = get_cached_choice(request_key)
+        if cached_choice is not None:
+            return encode_response(OpenAIChatResponse(model=selected_model, choices=[cached_choice]))
+
     # --- Call Poe and Parse the Response ---
     try:
-        poe_messages = [fp.ProtocolMessage(role="user", content=final_prompt_to_poe)]
-        final_text = ""
-        # Non-streaming is better for parsing tool calls vs. text
-        async for partial in fp.get_bot_response(messages=poe_messages, bot_name=selected_model, api_key=POE_API_KEY):
-            final_text += partial.text
-
+        # fp.ProtocolMessage needs text, so decode once, only on a cache miss
+        final_prompt_to_poe = prompt_bytes.decode()
+        final_text = await get_poe_text(request_key, final_prompt_to_poe, selected_model)
         final_text = final_text.strip()
         response_message = None
         finish_reason = "stop"
 
         # Check if the model wants to call a tool
-        if final_text.startswith("{") and final_text.endswith("}"):
+        # A tool call is a JSON object whose first key is "tool_calls"; whitespace
+        # after the brace varies (compact vs. pretty-printed), so skip it
+        if final_text.startswith("{") and final_text[1:].lstrip().startswith('"tool_calls"'):
             try:
-                parsed_json = json.loads(final_text)
+                parsed_json = orjson.loads(final_text)
                 if "tool_calls" in parsed_json:
-                    response_message = AssistantMessage(tool_calls=parsed_json["tool_calls"])
+                    # The only untrusted part of the response, so it is still validated
+                    tool_calls = msgspec.convert(parsed_json["tool_calls"], Optional[List[ToolCall]])
+                    response_message = AssistantMessage(tool_calls=tool_calls)
                     finish_reason = "tool_calls"
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 pass  # It wasn't valid JSON, so treat as text
 
         # If it's not a tool call, treat it as a standard text response
@@ -156,21 +331,23 @@ async def chat_completions(request: OpenAIChatRequest, authorization: Optional[s
             finish_reason = "stop"
 
         choice = ChatCompletionChoice(message=response_message, finish_reason=finish_reason)
-        return OpenAIChatResponse(model=selected_model, choices=[choice])
+        if use_cache:
+            cache_choice(request_key, choice)
+        return encode_response(OpenAIChatResponse(model=selected_model, choices=[choice]))
 
     except Exception as e:
         # Handle errors gracefully
         error_message = f"Error from Poe API: {str(e)}"
         response_message = AssistantMessage(content=error_message)
         choice = ChatCompletionChoice(message=response_message, finish_reason="stop")
-        return OpenAIChatResponse(model=selected_model, choices=[choice])
+        return encode_response(OpenAIChatResponse(model=selected_model, choices=[choice]))
 
 # --- MODAL APP SETUP ---
 app_modal = modal.App("poe-qwen-bridge-agent")
 
 image = (
     modal.Image.debian_slim()
-    .pip_install("fastapi", "uvicorn", "fastapi-poe", "pydantic")
+    .pip_install("fastapi", "uvicorn", "fastapi-poe", "msgspec", "orjson", "httpx[http2]")
 )
 
 @app_modal.function(
@@ -180,7 +357,7 @@ image = (
         modal.Secret.from_name("modal-auth-token-secret")
     ]
 )
-@modal.concurrent(max_inputs=10)
+@modal.concurrent(max_inputs=MAX_CONCURRENT_INPUTS)
 @modal.asgi_app()
 def fastapi_app():
     return app
\ No newline at end of file